@@ -1,48 +1,340 @@
 """
 Legal Document Analyzer - Dash Version with Hugging Face Inference API
 No local LLM needed! Uses Hugging Face's free Inference API.
+Set LLM_BACKEND=ollama to answer with a local Ollama model instead.
 """
 
 import os
 import dash
-from dash import dcc, html, Input, Output, State, callback
+from dash import dcc, html, Input, Output, State, callback, ClientsideFunction, DiskcacheManager
+import diskcache
+from flask_compress import Compress
 import plotly.express as px
 import plotly.graph_objs as go
 import pandas as pd
 import numpy as np
 from datetime import datetime
 import requests
+import ollama
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import re
+import string
+import threading
+import fcntl
+import tempfile
+import contextlib
+import time
+import uuid
+import faiss
+import torch
 
 # RAG imports
-from langchain.vectorstores import Chroma
-from langchain.embeddings import HuggingFaceEmbeddings
+from langchain.vectorstores import Chroma, FAISS
 from langchain.llms import HuggingFaceHub  # For HF Inference API
 from langchain.chains import RetrievalQA
 from langchain.prompts import PromptTemplate
 
+from embeddings_singleton import get_embeddings
+
 # ============================================
 # HUGGING FACE SETUP
 # ============================================
 
 # 🔑 Load HF token from environment (set in Hugging Face Spaces Secrets)
 HF_TOKEN = os.environ.get("HF_TOKEN")
-if not HF_TOKEN:
+
+# Optional self-hosted text-generation-inference endpoint (see README).
+# TGI batches concurrent requests continuously, unlike the serverless API
+TGI_URL = os.environ.get("TGI_URL")
+
+# LLM backend: "hf" (Inference API / TGI, default) or "ollama" (local)
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "hf")
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "llama3.2:3b")
+
+# The LLM is available with a local Ollama backend, an HF token, or a self-hosted endpoint
+LLM_ENABLED = LLM_BACKEND == "ollama" or bool(HF_TOKEN or TGI_URL)
+if not LLM_ENABLED:
     print("⚠️ WARNING: HF_TOKEN not found in environment variables!")
     print("Please add HF_TOKEN to your Hugging Face Space Secrets")
     print("The app will run in demo mode without actual LLM responses")
 
 # Model to use (free, fast, works well for legal text)
 # Options: "meta-llama/Llama-3.2-3B-Instruct", "microsoft/phi-3-mini-4k-instruct", "HuggingFaceH4/zephyr-7b-beta"
-HF_MODEL = "meta-llama/Llama-3.2-3B-Instruct"  # Good balance of quality and speed
+# Set HF_MODEL to a pre-quantized (AWQ / int8) variant to roughly double decode speed
+HF_MODEL = os.environ.get("HF_MODEL", "meta-llama/Llama-3.2-3B-Instruct")  # Good balance of quality and speed
+
+# Static instruction block - kept as the literal prefix of every prompt (never
+# interpolate into it) so cache-aware backends can reuse its KV-cache across calls
+SYSTEM_PREFIX = (
+    "You are a legal document analyst. Based on the following contract excerpts, answer the question.\n"
+    "Provide a concise, accurate answer based only on the context. If the answer cannot be found, say so.\n\n"
+)
+
+# Prompt template parsed once at import; SYSTEM_PREFIX stays its literal prefix
+PROMPT_TEMPLATE = PromptTemplate.from_template(
+    SYSTEM_PREFIX + "Context:\n{context}\n\nQuestion: {question}\nAnswer:"
+)
+
+# API endpoint and headers are constant for the whole process
+if TGI_URL:
+    API_URL = TGI_URL.rstrip("/") + "/generate_stream"
+else:
+    API_URL = f"https://api-inference.huggingface.co/models/{HF_MODEL}"
+headers = {"Authorization": f"Bearer {HF_TOKEN}"} if HF_TOKEN else {}
+
+# Pooled keep-alive session so Dash callbacks reuse TCP/TLS connections
+# instead of paying a fresh handshake on every query
+_session = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=[503, 504],
+        allowed_methods=["POST"],
+        raise_on_status=False  # Let the 503 "model loading" message through
+    )
+)
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)  # Self-hosted TGI is often plain HTTP inside the network
+
+_ollama_client = ollama.Client(host=OLLAMA_HOST)
+
+# ============================================
+# PROMPT COMPRESSION
+# ============================================
+
+# LLMLingua-2 shrinks the contract excerpts ~3x while keeping the salient
+# clauses, so fewer input tokens hit the rate-limited HF endpoint.
+# Set PROMPT_COMPRESSION=0 to skip loading the compressor model.
+PROMPT_COMPRESSION = os.environ.get("PROMPT_COMPRESSION", "1") == "1"
+MAX_CONTEXT_CHARS = 2000  # Safety cap, applied after compression
+
+compressor = None
+if PROMPT_COMPRESSION:
+    from llmlingua import PromptCompressor
+    compressor = PromptCompressor(
+        model_name="microsoft/llmlingua-2-xlm-roberta-large-meetingbank",
+        use_llmlingua2=True,
+        device_map="cpu"
+    )
+
+def compress_context(context):
+    """Compress contract excerpts for the prompt, falling back to a character cap"""
+    if compressor is not None and context:
+        try:
+            context = compressor.compress_prompt(
+                context, rate=0.33, force_tokens=['\n', '.']
+            )['compressed_prompt']
+        except Exception as e:
+            print(f"⚠️ Prompt compression failed, using truncated context: {e}")
+    return context[:MAX_CONTEXT_CHARS]
+
+# ============================================
+# EMBEDDINGS
+# ============================================
+
+EMBEDDING_DIM = 384  # all-MiniLM-L6-v2
+
+# Spaces run on shared CPUs - pin torch's intra-op threads explicitly
+torch.set_num_threads(int(os.environ.get("TORCH_THREADS", os.cpu_count())))
+
+# Same embedding model as the ingest scripts, loaded once per process (before
+# background callbacks fork, so workers inherit it). Always on CPU: CUDA can't
+# be re-initialized in a forked child, and one query doesn't need a GPU anyway
+embeddings = get_embeddings("cpu")
+
+def embed_query(text):
+    """Embed a single query as a (1, dim) float32 array for FAISS"""
+    # Not micro-batched: every search runs in its own forked background-callback
+    # process, so there is never a second query in the process to batch with
+    return np.asarray([embeddings.embed_query(text)], dtype=np.float32)
+
+# ============================================
+# SEMANTIC CACHE
+# ============================================
+
+# Repeat and paraphrased questions ("termination clauses in employment agreements")
+# are answered from this cache instead of paying another HF API round-trip
+SEMANTIC_CACHE_DIR = "./data/semantic_cache"
+SEMANTIC_CACHE_THRESHOLD = 0.95  # Cosine similarity needed to reuse an answer
+SEMANTIC_CACHE_MAX_ENTRIES = 1000  # Least recently used entries are evicted past this
+SEMANTIC_CACHE_INDEX = os.path.join(SEMANTIC_CACHE_DIR, "index.faiss")
+SEMANTIC_CACHE_ENTRIES = os.path.join(SEMANTIC_CACHE_DIR, "entries.json")
+SEMANTIC_CACHE_LOCKFILE = os.path.join(SEMANTIC_CACHE_DIR, ".lock")
+
+_cache_lock = threading.Lock()
+
+# Last-hit times for LRU eviction, keyed by entry id. Kept apart from
+# entries.json so a cache hit is one small write, not a full rewrite
+# (which would also make every other process reload the cache)
+_cache_last_used = diskcache.Cache(os.path.join(SEMANTIC_CACHE_DIR, "last_used"))
+
+@contextlib.contextmanager
+def _semantic_cache_lock(exclusive):
+    """
+    Hold the cache across threads and processes. Background callbacks run in
+    forked processes, so a threading.Lock alone can't keep a reader from
+    pairing one job's index with another job's entries.
+    """
+    os.makedirs(SEMANTIC_CACHE_DIR, exist_ok=True)
+    with _cache_lock, open(SEMANTIC_CACHE_LOCKFILE, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield  # The flock is released when lock_file closes
+
+def _load_semantic_cache():
+    """Load the cache index and its (query, sources, response) entries from disk"""
+    if os.path.exists(SEMANTIC_CACHE_INDEX) and os.path.exists(SEMANTIC_CACHE_ENTRIES):
+        try:
+            index = faiss.read_index(SEMANTIC_CACHE_INDEX)
+            with open(SEMANTIC_CACHE_ENTRIES, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            if index.ntotal == len(entries):
+                return index, entries
+        except Exception as e:
+            print(f"⚠️ Could not load semantic cache: {e}")
+    
+    # Inner product over normalized embeddings == cosine similarity
+    return faiss.IndexFlatIP(EMBEDDING_DIM), []
+
+def _save_semantic_cache():
+    """Persist the cache so it survives restarts (atomic replace, caller holds the exclusive lock)"""
+    fd, index_tmp = tempfile.mkstemp(dir=SEMANTIC_CACHE_DIR, suffix=".faiss.tmp")
+    os.close(fd)
+    faiss.write_index(_cache_index, index_tmp)
+    fd, entries_tmp = tempfile.mkstemp(dir=SEMANTIC_CACHE_DIR, suffix=".json.tmp")
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(_cache_entries, f)
+    os.replace(index_tmp, SEMANTIC_CACHE_INDEX)
+    os.replace(entries_tmp, SEMANTIC_CACHE_ENTRIES)
+
+def _cache_file_mtime():
+    try:
+        return os.path.getmtime(SEMANTIC_CACHE_ENTRIES)
+    except OSError:
+        return None
+
+def _refresh_semantic_cache():
+    """Reload the cache if another process (e.g. a background callback) wrote to it"""
+    global _cache_index, _cache_entries, _cache_mtime
+    mtime = _cache_file_mtime()
+    if mtime != _cache_mtime:
+        _cache_index, _cache_entries = _load_semantic_cache()
+        _cache_mtime = mtime
+
+with _semantic_cache_lock(exclusive=False):
+    _cache_index, _cache_entries = _load_semantic_cache()
+    _cache_mtime = _cache_file_mtime()
+
+def _persist_semantic_cache():
+    """Save the cache and remember its mtime so we don't reload our own write"""
+    global _cache_mtime
+    try:
+        _save_semantic_cache()
+        _cache_mtime = _cache_file_mtime()
+    except Exception as e:
+        print(f"⚠️ Could not save semantic cache: {e}")
+
+def semantic_cache_lookup(query_emb, sources, version):
+    """Return the cached response for a near-duplicate question over the same sources and version"""
+    with _semantic_cache_lock(exclusive=False):
+        _refresh_semantic_cache()
+        if _cache_index.ntotal == 0:
+            return None
+        
+        D, I = _cache_index.search(query_emb, min(5, _cache_index.ntotal))
+        for score, idx in zip(D[0], I[0]):
+            if score < SEMANTIC_CACHE_THRESHOLD:
+                break
+            entry = _cache_entries[idx]
+            if entry.get("sources") == sources and entry.get("version") == version:
+                if "id" in entry:
+                    _cache_last_used[entry["id"]] = time.time()
+                return entry["response"]
+    return None
+
+def semantic_cache_add(query_emb, query, sources, version, response):
+    """Store a fresh response in the cache (evicting the LRU entry when full) and persist it"""
+    with _semantic_cache_lock(exclusive=True):
+        _refresh_semantic_cache()
+        if _cache_index.ntotal >= SEMANTIC_CACHE_MAX_ENTRIES:
+            def last_used(i):
+                entry = _cache_entries[i]
+                return _cache_last_used.get(entry.get("id"), entry.get("last_used", 0))
+            lru = min(range(len(_cache_entries)), key=last_used)
+            _cache_index.remove_ids(np.array([lru], dtype=np.int64))  # Flat index ids shift down like the list
+            _cache_last_used.pop(_cache_entries[lru].get("id"), None)
+            del _cache_entries[lru]
+        _cache_index.add(query_emb)
+        _cache_entries.append({
+            "id": uuid.uuid4().hex,
+            "query": query,
+            "sources": sources,
+            "version": version,
+            "response": response,
+            "last_used": time.time()
+        })
+        _persist_semantic_cache()
+
+# ============================================
+# STANFORD MCC INDEX
+# ============================================
+
+# FAISS index built by ingest_stanford.py (int8 HNSW for large corpora, fp16
+# flat for small ones). Candidates are rescored against the fp16 vectors
+# (memory-mapped, so only the rows we touch are read from disk, then upcast).
+STANFORD_INDEX_PATH = "./data/stanford_faiss"
+RERANK_CANDIDATES = 200
+RERANK_TOP_K = 10
+MAX_CITATIONS = 3  # Source documents shown per query
+# efSearch for the Stanford HNSW index, set at load time (no rebuild needed).
+# Never below RERANK_CANDIDATES (200): HNSW can't return more results than
+# efSearch, so smaller values are raised to 200.
+STANFORD_HNSW_EF_SEARCH = int(os.environ.get("STANFORD_HNSW_EF_SEARCH", 256))
+
+stanford_db = None
+stanford_vectors = None
+stanford_index_version = None  # index.faiss mtime, changes whenever ingest_stanford.py re-runs
+if os.path.exists(os.path.join(STANFORD_INDEX_PATH, "index.faiss")):
+    print(f"📂 Loading Stanford MCC index from {STANFORD_INDEX_PATH}")
+    stanford_db = FAISS.load_local(
+        STANFORD_INDEX_PATH, embeddings, allow_dangerous_deserialization=True
+    )
+    if hasattr(stanford_db.index, "hnsw"):
+        stanford_db.index.hnsw.efSearch = max(STANFORD_HNSW_EF_SEARCH, RERANK_CANDIDATES)
+    stanford_vectors = np.load(os.path.join(STANFORD_INDEX_PATH, "vectors.npy"), mmap_mode='r')
+    stanford_index_version = os.path.getmtime(os.path.join(STANFORD_INDEX_PATH, "index.faiss"))
+
+def search_stanford(query_emb, k=RERANK_TOP_K):
+    """Fetch candidates from the int8 index and return the top-k after fp32 rescoring"""
+    _, I = stanford_db.index.search(query_emb, RERANK_CANDIDATES)
+    ids = I[0][I[0] >= 0]
+    if len(ids) == 0:
+        return []
+    
+    # A 200x384 matvec: BLAS does it in microseconds, with no JIT to pay per forked job
+    candidates = np.asarray(stanford_vectors[ids], dtype=np.float32)
+    scores = candidates @ query_emb[0]
+    top_ids = ids[np.argsort(-scores)[:k]]
+    return [stanford_db.docstore.search(stanford_db.index_to_docstore_id[int(i)]) for i in top_ids]
 
 # ============================================
 # DASH APP INITIALIZATION
 # ============================================
 
+# Background callbacks run in their own process, so a slow HF call
+# doesn't pin a Gunicorn worker thread for up to 30 seconds
+cache = diskcache.Cache("./cache")
+background_callback_manager = DiskcacheManager(cache)
+
 # Initialize the Dash app
 app = dash.Dash(
     __name__,
+    background_callback_manager=background_callback_manager,
     external_stylesheets=[
         'https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700&display=swap'
     ],
@@ -54,164 +346,34 @@ app = dash.Dash(
 # For Hugging Face Spaces deployment - THIS IS CRITICAL
 server = app.server
 
-# Custom CSS (same as before - keeping it clean)
-app.index_string = '''
-<!DOCTYPE html>
-<html>
-    <head>
-        {%metas%}
-        <title>⚖️ Legal Document Analyzer</title>
-        {%favicon%}
-        {%css%}
-        <style>
-            body {
-                font-family: 'Inter', sans-serif;
-                margin: 0;
-                padding: 0;
-                background-color: #f8f9fa;
-            }
-            .main-header {
-                background: linear-gradient(135deg, #1E3A8A 0%, #2563EB 100%);
-                color: white;
-                padding: 2rem;
-                text-align: center;
-                margin-bottom: 2rem;
-            }
-            .main-header h1 {
-                font-size: 2.5rem;
-                margin: 0;
-                font-weight: 700;
-            }
-            .main-header p {
-                font-size: 1.1rem;
-                opacity: 0.9;
-                margin: 0.5rem 0 0;
-            }
-            .container {
-                max-width: 1200px;
-                margin: 0 auto;
-                padding: 0 1.5rem;
-            }
-            .card {
-                background: white;
-                border-radius: 12px;
-                padding: 1.5rem;
-                box-shadow: 0 4px 6px rgba(0,0,0,0.05);
-                margin-bottom: 1.5rem;
-            }
-            .stat-grid {
-                display: grid;
-                grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
-                gap: 1rem;
-                margin-bottom: 1.5rem;
-            }
-            .stat-card {
-                background: linear-gradient(135deg, #f8f9fa 0%, #e9ecef 100%);
-                padding: 1.2rem;
-                border-radius: 10px;
-                text-align: center;
-            }
-            .stat-number {
-                font-size: 2rem;
-                font-weight: 700;
-                color: #1E3A8A;
-            }
-            .stat-label {
-                font-size: 0.9rem;
-                color: #6B7280;
-                margin-top: 0.3rem;
-            }
-            .query-box {
-                background: white;
-                border: 2px solid #e5e7eb;
-                border-radius: 12px;
-                padding: 1.5rem;
-                margin: 1.5rem 0;
-            }
-            .answer-box {
-                background: #f0f9ff;
-                border-left: 4px solid #2563EB;
-                padding: 1.5rem;
-                border-radius: 8px;
-                margin: 1rem 0;
-                font-size: 1rem;
-                line-height: 1.6;
-                white-space: pre-wrap;
-            }
-            .citation {
-                background: #f8f9fa;
-                border: 1px solid #e5e7eb;
-                border-radius: 6px;
-                padding: 1rem;
-                margin: 0.5rem 0;
-                font-size: 0.9rem;
-                color: #4B5563;
-            }
-            .citation small {
-                color: #2563EB;
-                font-weight: 500;
-            }
-            .btn-primary {
-                background: #2563EB;
-                color: white;
-                border: none;
-                padding: 0.75rem 1.5rem;
-                border-radius: 8px;
-                font-weight: 600;
-                cursor: pointer;
-                transition: background 0.2s;
-            }
-            .btn-primary:hover {
-                background: #1E3A8A;
-            }
-            .btn-primary:disabled {
-                background: #9CA3AF;
-                cursor: not-allowed;
-            }
-            .footer {
-                text-align: center;
-                padding: 2rem;
-                color: #6B7280;
-                font-size: 0.9rem;
-                border-top: 1px solid #e5e7eb;
-                margin-top: 3rem;
-            }
-            .data-source-tag {
-                display: inline-block;
-                padding: 0.2rem 0.8rem;
-                border-radius: 20px;
-                font-size: 0.8rem;
-                font-weight: 500;
-                margin-right: 0.5rem;
-            }
-            .source-stanford {
-                background: #DBEAFE;
-                color: #1E3A8A;
-            }
-            .source-sec {
-                background: #D1FAE5;
-                color: #065F46;
-            }
-            .token-warning {
-                background: #FEF3C7;
-                border-left: 4px solid #F59E0B;
-                padding: 1rem;
-                border-radius: 8px;
-                margin: 1rem 0;
-                color: #92400E;
-            }
-        </style>
-    </head>
-    <body>
-        {%app_entry%}
-        <footer>
-            {%config%}
-            {%scripts%}
-            {%renderer%}
-        </footer>
-    </body>
-</html>
-'''
+# Brotli/gzip-compress responses (page, JS bundles, callback JSON)
+server.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+server.config["COMPRESS_LEVEL"] = 6
+Compress(server)
+
+# Page title (styles live in assets/style.css, which Dash serves with cache headers)
+app.title = "⚖️ Legal Document Analyzer"
+
+# Static contract-type chart spec - module level so it is built once and can be reused
+_CONTRACT_TYPE_FIG = {
+    "data": [
+        {
+            "values": [40, 25, 15, 12, 8],
+            "labels": ["Employment", "M&A", "Lease", "Security", "Services"],
+            "type": "pie",
+            "name": "Contract Types",
+            "marker": {"colors": ["#2563EB", "#7C3AED", "#DB2777", "#EA580C", "#059669"]},
+            "hole": 0.4,
+            "textinfo": "label+percent"
+        }
+    ],
+    "layout": {
+        "title": "Contract Types in Stanford MCC",
+        "showlegend": False,
+        "height": 400,
+        "margin": {"t": 50, "b": 50, "l": 50, "r": 50}
+    }
+}
 
 # App layout
 app.layout = html.Div([
@@ -229,7 +391,7 @@ app.layout = html.Div([
         html.Div(id="token-warning", className="token-warning", children=[
             html.Strong("⚠️ HF_TOKEN not found! "),
             "The app is running in demo mode. Add your Hugging Face token to enable AI responses."
-        ]) if not HF_TOKEN else html.Div(),
+        ]) if not LLM_ENABLED else html.Div(),
         
         # Stats section
         html.Div(id="stats-section", className="stat-grid", children=[
@@ -298,14 +460,20 @@ app.layout = html.Div([
             
         ], className="card"),
         
+        # Live answer while tokens stream in from Hugging Face
+        html.Div(id="streaming-answer", className="answer-box", style={"display": "none"}),
+        
         # Loading indicator
         dcc.Loading(
             id="loading",
             type="circle",
-            children=html.Div(id="loading-output", className="card", children=[
-                html.Div("Enter a query above to analyze contracts.", 
-                        style={"text-align": "center", "color": "#6B7280", "padding": "2rem"})
-            ])
+            children=[
+                dcc.Store(id="results-store"),
+                html.Div(id="loading-output", className="card", children=[
+                    html.Div("Enter a query above to analyze contracts.", 
+                            style={"text-align": "center", "color": "#6B7280", "padding": "2rem"})
+                ])
+            ]
         ),
         
         # Analytics section
@@ -315,25 +483,7 @@ app.layout = html.Div([
             # Contract type distribution
             dcc.Graph(
                 id="contract-type-chart",
-                figure={
-                    "data": [
-                        {
-                            "values": [40, 25, 15, 12, 8],
-                            "labels": ["Employment", "M&A", "Lease", "Security", "Services"],
-                            "type": "pie",
-                            "name": "Contract Types",
-                            "marker": {"colors": ["#2563EB", "#7C3AED", "#DB2777", "#EA580C", "#059669"]},
-                            "hole": 0.4,
-                            "textinfo": "label+percent"
-                        }
-                    ],
-                    "layout": {
-                        "title": "Contract Types in Stanford MCC",
-                        "showlegend": False,
-                        "height": 400,
-                        "margin": {"t": 50, "b": 50, "l": 50, "r": 50}
-                    }
-                }
+                figure=_CONTRACT_TYPE_FIG
             )
         ], className="card"),
         
@@ -355,7 +505,7 @@ app.layout = html.Div([
     # Footer
     html.Div([
         html.P(f"© 2026 Legal Document Analyzer | Built with Dash + Hugging Face Spaces"),
-        html.P(f"Model: {HF_MODEL}", 
+        html.P(f"Model: {OLLAMA_MODEL if LLM_BACKEND == 'ollama' else HF_MODEL}", 
                style={"font-size": "0.8rem", "margin-top": "0.5rem"})
     ], className="footer")
 ])
@@ -364,28 +514,24 @@ app.layout = html.Div([
 # HELPER FUNCTIONS
 # ============================================
 
-def query_huggingface(prompt, context=""):
-    """
-    Query Hugging Face Inference API directly
-    """
-    if not HF_TOKEN:
-        return "⚠️ Demo mode: No HF_TOKEN provided. Add your token to enable AI responses."
-    
-    # Construct full prompt with context
-    full_prompt = f"""You are a legal document analyst. Based on the following contract excerpts, answer the question.
+# Blank, placeholder, and keyboard-mash queries are answered directly
+# instead of spending an embedding, a search, and an LLM call on them
+TRIVIAL_QUERIES = {"test", "testing", "hello", "hey", "help", "thanks", "thank you", "asdf", "qwerty", "foo bar"}
+TRIVIAL_QUERY_MESSAGE = "Please enter a more specific legal question."
 
-Context:
-{context[:2000]}  # Limit context to avoid token limits
+def is_trivial_query(query):
+    """True when a query is too short or generic to need the LLM"""
+    q = query.strip().lower()
+    return len(q) < 4 or q in TRIVIAL_QUERIES or not re.search(r"[a-z]{4,}", q)
 
-Question: {prompt}
+# Shown (and never cached) when a backend replies 200 with no generated text
+EMPTY_ANSWER_MESSAGE = "⚠️ The model returned an empty answer. Please try again."
 
-Provide a concise, accurate answer based only on the context. If the answer cannot be found, say so.
-Answer:"""
-    
-    # API endpoint
-    API_URL = f"https://api-inference.huggingface.co/models/{HF_MODEL}"
-    headers = {"Authorization": f"Bearer {HF_TOKEN}"}
-    
+def _query_hf(full_prompt, on_progress=None):
+    """
+    Hugging Face Inference API / TGI backend, streaming tokens as they arrive.
+    Returns (answer, ok) - ok is False for error and status messages.
+    """
     payload = {
         "inputs": full_prompt,
         "parameters": {
@@ -393,126 +539,229 @@ Answer:"""
             "temperature": 0.1,
             "do_sample": False,
             "return_full_text": False
-        }
+        },
+        "stream": True
     }
     
-    try:
-        response = requests.post(API_URL, headers=headers, json=payload, timeout=30)
+    with _session.post(API_URL, headers=headers, json=payload, timeout=30, stream=True) as response:
         
         if response.status_code == 200:
-            result = response.json()
-            if isinstance(result, list) and len(result) > 0:
-                return result[0].get('generated_text', str(result))
-            return str(result)
+            # Endpoints that ignore "stream" reply with a plain JSON body instead
+            if not response.headers.get("Content-Type", "").startswith("text/event-stream"):
+                result = response.json()
+                if isinstance(result, list) and result:
+                    result = result[0]
+                answer = result.get("generated_text", "") if isinstance(result, dict) else ""
+                return (answer, True) if answer.strip() else (EMPTY_ANSWER_MESSAGE, False)
+            
+            # Server-sent events: data:{"token": {"text": ..., "special": ...}, ...}
+            # text/event-stream carries no charset, so requests would guess
+            # ISO-8859-1 and garble §, em dashes and curly quotes
+            response.encoding = "utf-8"
+            answer_parts = []
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                frame = json.loads(line[len("data:"):])
+                if "error" in frame:
+                    return f"❌ Error: {frame['error']}", False
+                token = frame.get("token", {})
+                if token.get("special"):
+                    continue
+                answer_parts.append(token.get("text", ""))
+                if on_progress:
+                    on_progress("".join(answer_parts))
+            
+            answer = "".join(answer_parts)
+            return (answer, True) if answer.strip() else (EMPTY_ANSWER_MESSAGE, False)
         elif response.status_code == 503:
             # Model is loading
-            return "⏳ Model is loading on Hugging Face servers. Please try again in a few seconds."
+            return "⏳ Model is loading on Hugging Face servers. Please try again in a few seconds.", False
         else:
-            return f"❌ API Error {response.status_code}: {response.text}"
-            
+            return f"❌ API Error {response.status_code}: {response.text}", False
+
+def _query_ollama(full_prompt, on_progress=None):
+    """
+    Local Ollama backend, streaming tokens as they arrive.
+    Returns (answer, ok) like _query_hf.
+    """
+    answer_parts = []
+    for chunk in _ollama_client.generate(
+        model=OLLAMA_MODEL,
+        prompt=full_prompt,
+        stream=True,
+        options={"temperature": 0.1, "num_predict": 500}
+    ):
+        answer_parts.append(chunk.get("response", ""))
+        if on_progress:
+            on_progress("".join(answer_parts))
+    
+    answer = "".join(answer_parts)
+    return (answer, True) if answer.strip() else (EMPTY_ANSWER_MESSAGE, False)
+
+LLM_BACKENDS = {
+    "hf": _query_hf,
+    "ollama": _query_ollama
+}
+
+def query_llm(prompt, context="", on_progress=None):
+    """
+    Answer a question about the given contract context with the configured
+    LLM backend (LLM_BACKEND). on_progress(partial_answer) is called after
+    every generated token. Returns (answer, ok).
+    """
+    if not LLM_ENABLED:
+        return "⚠️ Demo mode: No HF_TOKEN provided. Add your token to enable AI responses.", False
+    
+    # Static instructions first, then (compressed) context, question last
+    full_prompt = PROMPT_TEMPLATE.format(context=compress_context(context), question=prompt)
+    
+    try:
+        return LLM_BACKENDS[LLM_BACKEND](full_prompt, on_progress)
     except Exception as e:
-        return f"❌ Error: {str(e)}"
+        return f"❌ Error: {str(e)}", False
 
 # ============================================
 # CALLBACKS
 # ============================================
 
+# Demo-mode answer, compiled once rather than re-assembled per click
+_DEMO_ANSWER_TMPL = string.Template(
+    "⚠️ **HF_TOKEN not configured.**\n\n"
+    "To enable real AI responses:\n"
+    "1. Get a free token from huggingface.co/settings/tokens\n"
+    "2. Add it to your Space Secrets as HF_TOKEN\n"
+    "3. Restart the app\n\n"
+    "For now, here's what your query would analyze:\n"
+    "Query: '$query'\n"
+    "Sources: $sources"
+)
+
+# Sample contexts and result cards used when there is no index to retrieve from.
+# They never change, so they're built once here rather than on every click.
+_STANFORD_CTX = """
+Employment Agreement between TechCorp and John Smith dated 2023-01-15:
+Section 5. Termination. This Agreement may be terminated by either party upon thirty (30) days written notice. 
+For cause termination, including material breach of confidentiality obligations, shall be effective immediately.
+Section 6. Confidentiality. Employee shall not disclose trade secrets for a period of two (2) years post-employment.
+"""
+
+_STANFORD_RESULT = {
+    "source": "stanford",
+    "label": "Employment Agreement • 2023-01-15",
+    "snippet": "Employment Agreement between TechCorp and John Smith..."
+}
+
+_SEC_CTX = """
+Apple Inc. Form 8-K filed 2024-02-20, Exhibit 10.1:
+Section 8. Termination. This Agreement may be terminated (a) by mutual written consent, 
+(b) by either party upon 60 days written notice, or (c) immediately by Company for cause, 
+including breach of confidentiality, violation of policies, or misconduct.
+"""
+
+_SEC_RESULT = {
+    "source": "sec",
+    "label": "Apple Inc. • 2024-02-20",
+    "snippet": "Apple Inc. Form 8-K filed 2024-02-20, Exhibit 10.1..."
+}
+
+# A cached answer is only reused for the same LLM and Stanford index that produced it
+SEMANTIC_CACHE_VERSION = {
+    "backend": LLM_BACKEND,
+    "model": OLLAMA_MODEL if LLM_BACKEND == "ollama" else (TGI_URL or HF_MODEL),
+    "stanford_index": stanford_index_version
+}
+
 @callback(
-    Output("loading-output", "children"),
+    Output("results-store", "data"),
     [Input("search-button", "n_clicks")],
     [State("query-input", "value"),
-     State("source-selector", "value")]
+     State("source-selector", "value")],
+    prevent_initial_call=True,  # No job per page load; ui.js renders the placeholder from the empty store
+    background=True,
+    running=[
+        (Output("search-button", "disabled"), True, False),
+        (Output("streaming-answer", "style"), {"display": "block"}, {"display": "none"})
+    ],
+    progress=[Output("streaming-answer", "children")],
+    progress_default=[""],
+    interval=200  # Poll for streamed tokens every 200ms
 )
-def search_contracts(n_clicks, query, sources):
-    """Handle contract search and analysis"""
+def search_contracts(set_progress, n_clicks, query, sources):
+    """Handle contract search and analysis - returns plain data rendered by assets/ui.js"""
     
     if not n_clicks or not query:
-        return html.Div("Enter a query above to analyze contracts.", 
-                       style={"text-align": "center", "color": "#6B7280", "padding": "2rem"})
+        return None
+    
+    if is_trivial_query(query):
+        return {
+            "query": query,
+            "answer_title": "💡 Need a Little More Detail",
+            "answer": TRIVIAL_QUERY_MESSAGE,
+            "results": []
+        }
+    
+    # Stanford MCC comes from the FAISS index when ingest_stanford.py has been run;
+    # otherwise (and for SEC, for now) we use sample contexts
+    query_emb = embed_query(query)
+    sources_key = sorted(sources)
     
-    # Simulate finding relevant documents (in production, this would query ChromaDB)
-    # For demo, we'll create sample contexts
+    # A near-duplicate of an earlier question over the same sources skips
+    # both retrieval and the LLM call
+    if LLM_ENABLED:
+        cached = semantic_cache_lookup(query_emb, sources_key, SEMANTIC_CACHE_VERSION)
+        if cached is not None:
+            return {"query": query, **cached}
     
     context_parts = []
     results = []
     
     if "stanford" in sources:
-        stanford_context = """
-        Employment Agreement between TechCorp and John Smith dated 2023-01-15:
-        Section 5. Termination. This Agreement may be terminated by either party upon thirty (30) days written notice. 
-        For cause termination, including material breach of confidentiality obligations, shall be effective immediately.
-        Section 6. Confidentiality. Employee shall not disclose trade secrets for a period of two (2) years post-employment.
-        """
-        context_parts.append(stanford_context)
-        
-        results.append(html.Div([
-            html.Div([
-                html.Span("Stanford MCC", className="data-source-tag source-stanford"),
-                html.Small(" Employment Agreement • 2023-01-15", style={"color": "#6B7280", "margin-left": "0.5rem"})
-            ]),
-            html.Div(
-                "Employment Agreement between TechCorp and John Smith...",
-                className="citation"
-            )
-        ], style={"margin-bottom": "1rem"}))
+        if stanford_db is not None:
+            docs = search_stanford(query_emb)
+            context_parts.extend(doc.page_content for doc in docs)
+            
+            for doc in docs[:MAX_CITATIONS]:
+                results.append({
+                    "source": "stanford",
+                    "label": f"{doc.metadata.get('type', 'Other')} • {doc.metadata.get('source', '')}",
+                    "snippet": doc.page_content[:300] + "..."
+                })
+        else:
+            context_parts.append(_STANFORD_CTX)
+            results.append(_STANFORD_RESULT)
     
     if "sec" in sources:
-        sec_context = """
-        Apple Inc. Form 8-K filed 2024-02-20, Exhibit 10.1:
-        Section 8. Termination. This Agreement may be terminated (a) by mutual written consent, 
-        (b) by either party upon 60 days written notice, or (c) immediately by Company for cause, 
-        including breach of confidentiality, violation of policies, or misconduct.
-        """
-        context_parts.append(sec_context)
-        
-        results.append(html.Div([
-            html.Div([
-                html.Span("SEC Live", className="data-source-tag source-sec"),
-                html.Small(" Apple Inc. • 2024-02-20", style={"color": "#6B7280", "margin-left": "0.5rem"})
-            ]),
-            html.Div(
-                "Apple Inc. Form 8-K filed 2024-02-20, Exhibit 10.1...",
-                className="citation"
-            )
-        ], style={"margin-bottom": "1rem"}))
+        context_parts.append(_SEC_CTX)
+        results.append(_SEC_RESULT)
     
-    # Get AI answer from Hugging Face
+    # Get AI answer from the LLM
     full_context = "\n\n".join(context_parts)
-    answer = query_huggingface(query, full_context)
-    
-    # Answer section
-    answer_section = html.Div([
-        html.H4("📝 Analysis Result", style={"margin": "1rem 0"}),
-        html.Div(answer, className="answer-box")
-    ])
+    answer, ok = query_llm(query, full_context,
+                           on_progress=lambda partial: set_progress((partial,)))
+    answer_title = "📝 Analysis Result"
     
     # Show token warning if needed
-    if not HF_TOKEN:
-        answer_section = html.Div([
-            html.H4("📝 Demo Mode", style={"margin": "1rem 0"}),
-            html.Div(
-                "⚠️ **HF_TOKEN not configured.**\n\n"
-                "To enable real AI responses:\n"
-                "1. Get a free token from huggingface.co/settings/tokens\n"
-                "2. Add it to your Space Secrets as HF_TOKEN\n"
-                "3. Restart the app\n\n"
-                "For now, here's what your query would analyze:\n"
-                f"Query: '{query}'\n"
-                f"Sources: {', '.join(sources)}",
-                className="answer-box",
-                style={"white-space": "pre-wrap"}
-            )
-        ])
+    if not LLM_ENABLED:
+        answer_title = "📝 Demo Mode"
+        answer = _DEMO_ANSWER_TMPL.substitute(query=query, sources=", ".join(sources))
     
-    # Combine all sections
-    final_output = html.Div([
-        html.H3(f"Results for: '{query}'", style={"margin-bottom": "1rem"}),
-        answer_section,
-        html.H4("📄 Source Documents", style={"margin": "1.5rem 0 1rem"}),
-        *results
-    ])
+    response = {
+        "answer_title": answer_title,
+        "answer": answer,
+        "results": results
+    }
+    if ok:
+        semantic_cache_add(query_emb, query, sources_key, SEMANTIC_CACHE_VERSION, response)
     
-    return final_output
+    return {"query": query, **response}
+
+# Build the result cards in the browser (assets/ui.js) from the data above
+app.clientside_callback(
+    ClientsideFunction(namespace="ui", function_name="renderResults"),
+    Output("loading-output", "children"),
+    Input("results-store", "data")
+)
 
 # Run the app
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+/*
+ * Client-side rendering of search results.
+ * search_contracts returns plain data; the styled cards are built here
+ * so the server doesn't construct and serialize the component tree.
+ */
+
+function h(type, props, children) {
+    return {
+        namespace: "dash_html_components",
+        type: type,
+        props: Object.assign({}, props || {}, {children: children})
+    };
+}
+
+var SOURCE_TAGS = {
+    stanford: {text: "Stanford MCC", className: "data-source-tag source-stanford"},
+    sec: {text: "SEC Live", className: "data-source-tag source-sec"}
+};
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    ui: {
+        renderResults: function(data) {
+            if (!data) {
+                return h("Div", {
+                    style: {textAlign: "center", color: "#6B7280", padding: "2rem"}
+                }, "Enter a query above to analyze contracts.");
+            }
+
+            var results = (data.results || []).map(function(result) {
+                var tag = SOURCE_TAGS[result.source];
+                return h("Div", {style: {marginBottom: "1rem"}}, [
+                    h("Div", {}, [
+                        h("Span", {className: tag.className}, tag.text),
+                        h("Small", {style: {color: "#6B7280", marginLeft: "0.5rem"}}, " " + result.label)
+                    ]),
+                    h("Div", {className: "citation"}, result.snippet)
+                ]);
+            });
+
+            return h("Div", {}, [
+                h("H3", {style: {marginBottom: "1rem"}}, "Results for: '" + data.query + "'"),
+                h("Div", {}, [
+                    h("H4", {style: {margin: "1rem 0"}}, data.answer_title),
+                    h("Div", {className: "answer-box"}, data.answer)
+                ]),
+                h("H4", {style: {margin: "1.5rem 0 1rem"}}, "📄 Source Documents")
+            ].concat(results));
+        }
+    }
+});
@@ -0,0 +1,93 @@
+"""
+Shared Embedding Model
+One lazily-loaded all-MiniLM-L6-v2 instance per process, used by app.py and both ingest scripts
+"""
+
+import os
+import functools
+import numpy as np
+import torch
+from optimum.onnxruntime import ORTModelForFeatureExtraction
+from transformers import AutoTokenizer
+from langchain.embeddings import HuggingFaceEmbeddings
+from langchain.schema.embeddings import Embeddings
+
+# Embed on the GPU when there is one (compute-bound matmul), else fall back to CPU
+EMBED_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+# Load the embedding model from a path baked in at build time when available,
+# so the first query after a Space wakes up doesn't pay the model download
+EMBEDDING_MODEL_PATH = os.environ.get("EMBEDDING_MODEL_PATH", "/models/minilm")
+EMBEDDING_MODEL = EMBEDDING_MODEL_PATH if os.path.isdir(EMBEDDING_MODEL_PATH) else "all-MiniLM-L6-v2"
+
+# INT8-quantized ONNX export of the same model (see README), ~3x faster on CPU
+EMBEDDING_ONNX_PATH = os.environ.get("EMBEDDING_ONNX_PATH", "/models/minilm-int8")
+
+class ONNXEmbeddings(Embeddings):
+    """MiniLM on ONNX Runtime with mean pooling - drop-in for HuggingFaceEmbeddings"""
+    
+    def __init__(self, model_path, file_name="model_quantized.onnx", batch_size=64, max_length=256):
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_path, file_name=file_name)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.batch_size = batch_size
+        self.max_length = max_length
+    
+    def _encode(self, texts):
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            batch = self.tokenizer(
+                texts[i:i + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np"
+            )
+            hidden = self.model(**batch).last_hidden_state
+            
+            # Mean pooling over real tokens, then L2-normalize (as sentence-transformers does)
+            mask = batch["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            vectors.append(pooled)
+        
+        return np.vstack(vectors).tolist() if vectors else []
+    
+    def embed_documents(self, texts):
+        return self._encode(list(texts))
+    
+    def embed_query(self, text):
+        return self._encode([text])[0]
+
+def embedding_model_id(device=EMBED_DEVICE):
+    """Name of the exact model variant get_embeddings(device) loads (for keying cached vectors)"""
+    if device == "cuda":
+        return f"{EMBEDDING_MODEL}:cuda-fp16"
+    if os.path.isdir(EMBEDDING_ONNX_PATH):
+        return f"{os.path.abspath(EMBEDDING_ONNX_PATH)}:onnx-int8"
+    return f"{EMBEDDING_MODEL}:cpu-fp32"
+
+@functools.lru_cache(maxsize=None)
+def get_embeddings(device=EMBED_DEVICE):
+    """
+    Load the embedding model on first use and return the same instance afterwards.
+    device="cuda" gives FP16 PyTorch on the GPU (ingest); device="cpu" gives the
+    INT8 ONNX model when exported, else PyTorch on CPU.
+    """
+    if device == "cuda":
+        embeddings = HuggingFaceEmbeddings(
+            model_name=EMBEDDING_MODEL,
+            model_kwargs={'device': 'cuda'},
+            encode_kwargs={'batch_size': 256, 'normalize_embeddings': True, 'convert_to_numpy': True}
+        )
+        embeddings.client.half()  # FP16 on GPU
+        return embeddings
+    
+    if os.path.isdir(EMBEDDING_ONNX_PATH):
+        return ONNXEmbeddings(EMBEDDING_ONNX_PATH)
+    
+    # Normalized so inner product == cosine
+    return HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL,
+        model_kwargs={'device': 'cpu'},
+        encode_kwargs={'batch_size': 64, 'normalize_embeddings': True}
+    )
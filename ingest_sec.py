@@ -4,15 +4,20 @@ Fetches recent contracts via SEC API and stores in ChromaDB
 """
 
 import os
-import time
-import requests
+import re
+import asyncio
+import queue
+import threading
+import httpx
+from aiolimiter import AsyncLimiter
 from sec_api import QueryApi
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 from langchain.schema import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.vectorstores import Chroma
+import chromadb
 from datetime import datetime, timedelta
+from embeddings_singleton import get_embeddings
+from text_utils import MAX_TEXT_CHARS, MAX_HTML_CHARS, normalize_whitespace
 
 # 🔑 SEC API KEY - LOAD FROM ENVIRONMENT
 SEC_API_KEY = os.environ.get("SEC_API_KEY")
@@ -24,6 +29,26 @@ CHROMA_DB_PATH = "./data/chroma_db"
 COLLECTION_NAME = "sec_live"
 DAYS_TO_FETCH = 30
 MAX_FILINGS = 20
+ADD_BATCH_SIZE = 256  # Chunks per collection.upsert call
+MAX_CONCURRENT_DOWNLOADS = 5
+SEC_REQUESTS_PER_SECOND = 10  # SEC's fair-access limit
+SEC_CACHE_PATH = "./data/sec_cache"  # Raw exhibit HTML by accessionNo (filings are immutable)
+PARSE_WORKERS = 2  # Parser/splitter threads between the downloader and the embedder
+
+# <meta charset=...> / <meta http-equiv content="...; charset=..."> near the top of the page
+_META_CHARSET = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+
+# HNSW index tuning for the SEC Chroma collection (Chroma defaults are M=16,
+# construction_ef=100, search_ef=10). All of these, search_ef included, are
+# fixed when the collection is first created: changing SEC_HNSW_EF_SEARCH
+# later needs the collection deleted and re-ingested.
+SEC_HNSW_EF_SEARCH = int(os.environ.get("SEC_HNSW_EF_SEARCH", 100))
+COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 24,
+    "hnsw:construction_ef": 128,
+    "hnsw:search_ef": SEC_HNSW_EF_SEARCH
+}
 
 def fetch_sec_filings():
     """Fetch recent material contracts from SEC"""
@@ -66,8 +91,8 @@ def fetch_sec_filings():
     
     return filings
 
-def download_contract_text(filing):
-    """Download and parse contract text"""
+async def download_contract(client, semaphore, limiter, filing):
+    """Download one exhibit's raw HTML (from the disk cache when we have it)"""
     
     # Find exhibit URL
     exhibit_url = None
@@ -77,7 +102,7 @@ def download_contract_text(filing):
             break
     
     if not exhibit_url:
-        return "", None
+        return None, None
     
     metadata = {
         "source": exhibit_url,
@@ -88,31 +113,140 @@ def download_contract_text(filing):
         "form_type": filing.get('formType', '')
     }
     
+    accession_no = filing.get('accessionNo')
+    cache_path = os.path.join(SEC_CACHE_PATH, f"{accession_no}.html") if accession_no else None
+    
     try:
-        headers = {'User-Agent': 'Legal Document Analyzer (your@email.com)'}
-        response = requests.get(exhibit_url, headers=headers, timeout=30)
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                return f.read(), metadata
+        
+        # Only the network fetch is async; the semaphore caps open connections and
+        # the token bucket keeps us under SEC's rate limit without a fixed sleep
+        async with semaphore, limiter:
+            response = await client.get(exhibit_url, timeout=30)
         
         if response.status_code == 200:
-            soup = BeautifulSoup(response.content, 'html.parser')
-            
-            # Remove scripts
-            for script in soup(["script", "style"]):
-                script.decompose()
+            html_content = response.content
             
-            text = soup.get_text()
-            # Clean up
-            text = ' '.join(text.split())
+            # Write atomically so an interrupted run never leaves a partial file behind
+            if cache_path:
+                tmp_path = cache_path + ".tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(html_content)
+                os.replace(tmp_path, cache_path)
             
-            # Truncate if too long
-            if len(text) > 50000:
-                text = text[:50000] + "... [truncated]"
-            
-            return text, metadata
+            return html_content, metadata
     
     except Exception as e:
         print(f"   ❌ Download error: {e}")
     
-    return "", None
+    return None, None
+
+def decode_html(html_content):
+    """Decode exhibit bytes to text (lexbor assumes UTF-8 and ignores <meta charset>)"""
+    match = _META_CHARSET.search(html_content[:4096])
+    if match:
+        charset = match.group(1).decode('ascii').lower()
+        # Browsers read latin-1/ASCII declarations as cp1252, and so do EDGAR filers
+        if charset in ('iso-8859-1', 'latin-1', 'latin1', 'us-ascii', 'ascii'):
+            charset = 'cp1252'
+        try:
+            return html_content.decode(charset, errors='replace')
+        except LookupError:
+            pass  # Unknown charset name
+    
+    try:
+        return html_content.decode('utf-8')
+    except UnicodeDecodeError:
+        return html_content.decode('cp1252', errors='replace')
+
+def parse_contract_html(html_content):
+    """Extract clean contract text from exhibit HTML"""
+    try:
+        html_text = decode_html(html_content)
+        if len(html_text) > MAX_HTML_CHARS:
+            head = html_text[:MAX_HTML_CHARS]
+            html_text = head.rpartition('<')[0] or head  # Drop the half-cut tag, if any
+        tree = LexborHTMLParser(html_text)
+        
+        # Remove scripts
+        for tag in tree.css('script, style'):
+            tag.decompose()
+        
+        text = tree.body.text() if tree.body else ''
+        text = normalize_whitespace(text)
+        
+        # Truncate if too long
+        if len(text) > MAX_TEXT_CHARS:
+            text = text[:MAX_TEXT_CHARS] + "... [truncated]"
+        
+        return text
+    
+    except Exception as e:
+        print(f"   ❌ Parse error: {e}")
+        return ""
+
+async def download_all(filings, parse_q):
+    """Download all exhibits concurrently, handing each to the parsers as soon as it arrives"""
+    os.makedirs(SEC_CACHE_PATH, exist_ok=True)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    limiter = AsyncLimiter(SEC_REQUESTS_PER_SECOND, 1)
+    headers = {'User-Agent': 'Legal Document Analyzer (your@email.com)'}
+    
+    async def fetch(filing):
+        html_content, metadata = await download_contract(client, semaphore, limiter, filing)
+        if html_content:
+            parse_q.put((html_content, metadata))
+    
+    async with httpx.AsyncClient(headers=headers, follow_redirects=True) as client:
+        await asyncio.gather(*[fetch(filing) for filing in filings])
+
+# ============================================
+# PIPELINE STAGES
+# ============================================
+# download (network) -> parse + split (CPU) -> embed + write (GPU / disk).
+# Each stage runs in its own thread(s) and hands work on through a queue, so
+# network waits, parsing and embedding overlap instead of running back to back.
+# None on a queue means "no more work" from one upstream worker.
+
+def _download_stage(filings, parse_q):
+    """Stage 1: run the async downloader, then tell every parser to stop"""
+    try:
+        asyncio.run(download_all(filings, parse_q))
+    finally:
+        for _ in range(PARSE_WORKERS):
+            parse_q.put(None)
+
+def _parse_stage(parse_q, embed_q, text_splitter):
+    """Stage 2: parse and split each exhibit into (id, chunk) pairs"""
+    try:
+        while True:
+            item = parse_q.get()
+            if item is None:
+                break
+            
+            html_content, metadata = item
+            text = parse_contract_html(html_content)
+            if not text:
+                continue
+            
+            chunks = text_splitter.split_documents([Document(page_content=text, metadata=metadata)])
+            # Stable ids (exhibit URL + chunk number) so re-runs overwrite instead of duplicating
+            embed_q.put([(f"{metadata['source']}#{n}", chunk) for n, chunk in enumerate(chunks, 1)])
+            print(f"   ✅ {metadata['ticker']} - {metadata['filed_at']}: {len(chunks)} chunks")
+    finally:
+        embed_q.put(None)
+
+def _write_batch(collection, embeddings, pending):
+    """Stage 3 helper: embed a batch of chunks in one call and upsert the vectors"""
+    texts = [chunk.page_content for _, chunk in pending]
+    collection.upsert(
+        ids=[chunk_id for chunk_id, _ in pending],
+        embeddings=embeddings.embed_documents(texts),
+        documents=texts,
+        metadatas=[chunk.metadata for _, chunk in pending]
+    )
 
 def ingest_sec():
     """Main SEC ingestion function"""
@@ -131,48 +265,50 @@ def ingest_sec():
     
     # Step 2: Initialize components
     print("\n🔤 Initializing embedding model...")
-    embeddings = HuggingFaceEmbeddings(
-        model_name="all-MiniLM-L6-v2",
-        model_kwargs={'device': 'cpu'}
-    )
+    embeddings = get_embeddings()  # GPU/FP16 when available
     
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=1000,
-        chunk_overlap=200
+        chunk_overlap=200,
+        separators=["\n\n", "\n", ". ", " "],
+        length_function=len  # Characters, no tokenizer call per chunk
     )
     
-    # Step 3: Initialize ChromaDB (CREATES folder if needed)
-    vectordb = Chroma(
-        persist_directory=CHROMA_DB_PATH,
-        embedding_function=embeddings,
-        collection_name=COLLECTION_NAME
+    # Step 3: Initialize ChromaDB (CREATES folder if needed, persists on every write)
+    client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
+    collection = client.get_or_create_collection(
+        name=COLLECTION_NAME,
+        metadata=COLLECTION_METADATA
     )
     
-    # Step 4: Process each filing
+    # Step 4: Start the download and parse stages
+    print(f"\n📥 Processing {len(filings)} filings...")
+    parse_q = queue.Queue()
+    embed_q = queue.Queue()
+    
+    threading.Thread(target=_download_stage, args=(filings, parse_q), daemon=True).start()
+    for _ in range(PARSE_WORKERS):
+        threading.Thread(target=_parse_stage, args=(parse_q, embed_q, text_splitter), daemon=True).start()
+    
+    # Step 5: Embed and write on this thread, in batches of ADD_BATCH_SIZE chunks,
+    # until every parser has finished
     contracts_added = 0
     chunks_added = 0
+    pending = []
+    parsers_done = 0
     
-    print(f"\n📥 Processing {len(filings)} filings...")
-    
-    for i, filing in enumerate(filings, 1):
-        print(f"\n[{i}/{len(filings)}] {filing.get('ticker', 'N/A')} - {filing.get('filedAt', '')[:10]}")
-        
-        text, metadata = download_contract_text(filing)
-        
-        if text and metadata:
-            doc = Document(page_content=text, metadata=metadata)
-            chunks = text_splitter.split_documents([doc])
-            
-            if chunks:
-                vectordb.add_documents(chunks)
-                vectordb.persist()
-                
-                contracts_added += 1
-                chunks_added += len(chunks)
-                print(f"   ✅ Added {len(chunks)} chunks")
+    while parsers_done < PARSE_WORKERS:
+        item = embed_q.get()
+        if item is None:
+            parsers_done += 1
+        else:
+            pending.extend(item)
+            contracts_added += 1
         
-        # Rate limiting
-        time.sleep(0.5)
+        if pending and (len(pending) >= ADD_BATCH_SIZE or parsers_done == PARSE_WORKERS):
+            _write_batch(collection, embeddings, pending)
+            chunks_added += len(pending)
+            pending = []
     
     # Summary
     print("\n" + "="*60)
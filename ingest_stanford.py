@@ -5,47 +5,187 @@ Optimized for ~3GB dataset
 
 import os
 import glob
+import hashlib
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from langchain.document_loaders import DirectoryLoader, TextLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.vectorstores import Chroma
+from langchain.vectorstores import FAISS
+from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.schema import Document
-from bs4 import BeautifulSoup
+import faiss
+import numpy as np
+import ahocorasick
+from lxml import etree
 import time
 from tqdm import tqdm  # For progress bars (pip install tqdm)
+from embeddings_singleton import get_embeddings, embedding_model_id
+from text_utils import MAX_TEXT_CHARS, MAX_HTML_CHARS, normalize_whitespace
 
 # Configuration
 MCC_FOLDER = "./data/mcc_download"
-CHROMA_DB_PATH = "./data/chroma_db"
-COLLECTION_NAME = "stanford_mcc"
+FAISS_INDEX_PATH = "./data/stanford_faiss"
+
+# The corpus is written once and only read afterwards, so it lives in a FAISS
+# index rather than Chroma. Small corpora get an exhaustive index over fp16
+# vectors (no build cost, half the RAM of fp32); large ones get HNSW over int8
+# scalar-quantized vectors, 4x smaller than fp32, so the 1M-contract index
+# stays in RAM. The fp16 vectors are saved alongside (vectors.npy) for
+# reranking the final candidates in app.py.
+FLAT_INDEX_MAX_CHUNKS = 100_000
+HNSW_M = 24
+HNSW_EF_CONSTRUCTION = 128
+
+# Chunk embeddings cached across runs, keyed by SHA-256 of the model id + chunk text
+EMBEDDING_CACHE_PATH = "./data/embedding_cache.sqlite"
+
+# Filename keywords for contract type, in priority order (first matching type wins)
+CONTRACT_TYPE_KEYWORDS = [
+    ("Employment", ["employ", "compensation", "severance"]),
+    ("M&A", ["merger", "acquisition", "merger agreement"]),
+    ("Lease", ["lease", "rental"]),
+    ("Security", ["credit", "loan", "security", "note"]),
+    ("Services", ["service", "consulting", "professional"]),
+]
+
+# All keywords compiled into one Aho-Corasick automaton: a single pass per filename
+_CONTRACT_TYPE_AUTOMATON = ahocorasick.Automaton()
+for priority, (label, words) in enumerate(CONTRACT_TYPE_KEYWORDS):
+    for word in words:
+        _CONTRACT_TYPE_AUTOMATON.add_word(word, (priority, label))
+_CONTRACT_TYPE_AUTOMATON.make_automaton()
 
 # Create output folder
-os.makedirs(CHROMA_DB_PATH, exist_ok=True)
+os.makedirs(FAISS_INDEX_PATH, exist_ok=True)
+
+class _TextCollector:
+    """lxml parser target that keeps body text and drops head/script/style subtrees"""
+    
+    SKIP_TAGS = {'head', 'script', 'style'}
+    
+    def __init__(self):
+        self.parts = []
+        self.skip_depth = 0
+    
+    def start(self, tag, attrib):
+        if self.skip_depth or tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+    
+    def end(self, tag):
+        if self.skip_depth:
+            self.skip_depth -= 1
+    
+    def data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+    
+    def close(self):
+        return ''.join(self.parts)
 
 def extract_text_from_html(file_path):
     """Extract clean text from HTML contract files"""
     try:
+        # Stream the file through a parser target: no tree is built and the
+        # raw HTML is never held in memory, only a 64KB window and the text
+        parser = etree.HTMLParser(target=_TextCollector())
+        remaining = MAX_HTML_CHARS
         with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            html_content = f.read()
+            while remaining > 0:
+                chunk = f.read(min(65536, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                if remaining == 0:
+                    chunk = chunk.rpartition('<')[0] or chunk  # Don't emit a half-read tag as text
+                parser.feed(chunk)
+        text = parser.close()
         
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # Remove script and style elements
-        for script in soup(["script", "style"]):
-            script.decompose()
-        
-        text = soup.get_text()
-        
-        # Clean up whitespace
-        lines = (line.strip() for line in text.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        text = ' '.join(chunk for chunk in chunks if chunk)
-        
-        return text
+        return normalize_whitespace(text)
     except Exception as e:
         print(f"Error processing {file_path}: {e}")
         return ""
 
+def extract_text_from_txt(file_path):
+    """Read a plain-text contract file (no markup, so no parsing)"""
+    try:
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            text = f.read(MAX_HTML_CHARS)
+        return normalize_whitespace(text)
+    except Exception as e:
+        print(f"Error processing {file_path}: {e}")
+        return ""
+
+class CachedEmbeddings:
+    """Wraps embed_documents with an on-disk cache so unchanged chunks are never re-embedded"""
+    
+    def __init__(self, embeddings, db_path, model_id):
+        self.embeddings = embeddings
+        self.model_id = model_id  # Part of every key, so another model never reuses these vectors
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, vector BLOB)")
+    
+    def embed_documents(self, texts):
+        """Return a float32 matrix of embeddings, only computing the cache misses"""
+        prefix = self.model_id.encode('utf-8') + b'\0'
+        hashes = [hashlib.sha256(prefix + text.encode('utf-8')).hexdigest() for text in texts]
+        
+        # Look up known chunks (batched to stay under SQLite's variable limit)
+        found = {}
+        unique_hashes = list(dict.fromkeys(hashes))
+        for i in range(0, len(unique_hashes), 900):
+            batch = unique_hashes[i:i + 900]
+            rows = self.conn.execute(
+                f"SELECT hash, vector FROM embeddings WHERE hash IN ({','.join('?' * len(batch))})", batch
+            )
+            for h, blob in rows:
+                found[h] = np.frombuffer(blob, dtype=np.float16)
+        
+        # Embed the misses in one batch and store them as float16 (768 bytes each)
+        misses = {h: text for h, text in zip(hashes, texts) if h not in found}
+        print(f"   Embedding cache: {len(unique_hashes) - len(misses)} hits, {len(misses)} misses")
+        if misses:
+            miss_hashes = list(misses)
+            vectors = np.asarray(
+                self.embeddings.embed_documents([misses[h] for h in miss_hashes]), dtype=np.float16
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (hash, vector) VALUES (?, ?)",
+                [(h, vector.tobytes()) for h, vector in zip(miss_hashes, vectors)]
+            )
+            self.conn.commit()
+            found.update(zip(miss_hashes, vectors))
+        
+        return np.stack([found[h] for h in hashes]).astype(np.float32)
+
+def _process_file(file_path):
+    """Extract one contract file into a Document (None if it's empty)"""
+    filename = os.path.basename(file_path)
+    
+    # Extract text
+    if os.path.splitext(filename)[1].lower() == '.txt':
+        text = extract_text_from_txt(file_path)
+    else:
+        text = extract_text_from_html(file_path)
+    
+    if len(text) < 100:  # Skip empty files
+        return None
+    
+    # Try to determine contract type from filename
+    filename_lower = filename.lower()
+    matches = [value for _, value in _CONTRACT_TYPE_AUTOMATON.iter(filename_lower)]
+    contract_type = min(matches)[1] if matches else "Other"
+    
+    return Document(
+        page_content=text[:MAX_TEXT_CHARS],  # Limit size for consistency
+        metadata={
+            "source": filename,
+            "type": contract_type,
+            "source_type": "stanford_mcc",
+            "file_path": file_path,
+            "size_bytes": os.path.getsize(file_path)  # Whole file, not just the capped read
+        }
+    )
+
 def load_stanford_contracts():
     """Load contracts from Stanford MCC folder"""
     documents = []
@@ -64,41 +204,13 @@ def load_stanford_contracts():
         print("Please place your Stanford MCC files there.")
         return []
     
-    # Process with progress bar
-    for file_path in tqdm(all_files, desc="Processing contracts"):
-        filename = os.path.basename(file_path)
-        
-        # Extract text
-        text = extract_text_from_html(file_path)
-        
-        if len(text) < 100:  # Skip empty files
-            continue
-        
-        # Try to determine contract type from filename
-        filename_lower = filename.lower()
-        contract_type = "Other"
-        
-        if any(word in filename_lower for word in ["employ", "compensation", "severance"]):
-            contract_type = "Employment"
-        elif any(word in filename_lower for word in ["merger", "acquisition", "merger agreement"]):
-            contract_type = "M&A"
-        elif any(word in filename_lower for word in ["lease", "rental"]):
-            contract_type = "Lease"
-        elif any(word in filename_lower for word in ["credit", "loan", "security", "note"]):
-            contract_type = "Security"
-        elif any(word in filename_lower for word in ["service", "consulting", "professional"]):
-            contract_type = "Services"
-        
-        documents.append(Document(
-            page_content=text[:50000],  # Limit size for consistency
-            metadata={
-                "source": filename,
-                "type": contract_type,
-                "source_type": "stanford_mcc",
-                "file_path": file_path,
-                "size_chars": len(text)
-            }
-        ))
+    # Parse files on all cores (HTML parsing is CPU-bound, files are independent).
+    # chunksize amortizes IPC since each file only takes a few milliseconds.
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for doc in tqdm(executor.map(_process_file, all_files, chunksize=32),
+                        total=len(all_files), desc="Processing contracts"):
+            if doc is not None:
+                documents.append(doc)
     
     print(f"\n✅ Loaded {len(documents)} contracts")
     return documents
@@ -132,25 +244,40 @@ def ingest_stanford():
     
     # Step 3: Create embeddings
     print("\n🔤 Creating embeddings (this will take time)...")
-    embeddings = HuggingFaceEmbeddings(
-        model_name="all-MiniLM-L6-v2",  # Fast, good quality
-        model_kwargs={'device': 'cpu'}
-    )
+    embeddings = get_embeddings()  # GPU/FP16 when available
     
-    # Step 4: Store in ChromaDB
-    print(f"\n💾 Storing in ChromaDB: {CHROMA_DB_PATH}")
-    print(f"   Collection: {COLLECTION_NAME}")
+    texts = [chunk.page_content for chunk in chunks]
+    vectors = CachedEmbeddings(embeddings, EMBEDDING_CACHE_PATH, embedding_model_id()).embed_documents(texts)
     
-    vectordb = Chroma.from_documents(
-        documents=chunks,
-        embedding=embeddings,
-        persist_directory=CHROMA_DB_PATH,
-        collection_name=COLLECTION_NAME
+    # Step 4: Build FAISS index
+    if len(vectors) < FLAT_INDEX_MAX_CHUNKS:
+        print(f"\n💾 Building fp16 flat index: {FAISS_INDEX_PATH}")
+        index = faiss.IndexScalarQuantizer(
+            vectors.shape[1], faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT
+        )
+    else:
+        print(f"\n💾 Building int8 HNSW index: {FAISS_INDEX_PATH}")
+        index = faiss.IndexHNSWSQ(
+            vectors.shape[1], faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT
+        )
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.train(vectors)  # Learns the per-dimension int8 ranges
+    
+    vectordb = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={}
+    )
+    vectordb.add_embeddings(
+        text_embeddings=zip(texts, vectors),
+        metadatas=[chunk.metadata for chunk in chunks]
     )
     
     # Step 5: Persist
     print("\n💿 Saving to disk...")
-    vectordb.persist()
+    vectordb.save_local(FAISS_INDEX_PATH)
+    np.save(os.path.join(FAISS_INDEX_PATH, "vectors.npy"), vectors.astype(np.float16))
     
     elapsed = time.time() - start_time
     minutes = int(elapsed // 60)
@@ -163,8 +290,7 @@ def ingest_stanford():
     print(f"📊 Summary:")
     print(f"   - Files processed: {len(contracts)}")
     print(f"   - Total chunks: {len(chunks)}")
-    print(f"   - Database: {CHROMA_DB_PATH}")
-    print(f"   - Collection: {COLLECTION_NAME}")
+    print(f"   - Index: {FAISS_INDEX_PATH}")
     print(f"   - Time taken: {minutes}m {seconds}s")
     print("="*60)
 